@@ -34,6 +34,9 @@ setup(
     python_requires=">=3.7",
     install_requires=requirements,
     extras_require={
+        "numba": [
+            "numba>=0.53",
+        ],
         "dev": [
             "pytest>=6.0",
             "pytest-cov",
@@ -1,18 +1,154 @@
 """
 Core functionality for TCR shuffling.
 """
+import functools
+import logging
+import os
+import pickle
+
+import numpy as np
 import pandas as pd
-import random
-from .utils import (
-    label_cdr3_germline_vj_regions,
-    best_d_alignment, 
-    choose_cutpoints_around_d
+from .utils import build_d_index, label_and_find_d_batch, sample_cutpoints
+
+logger = logging.getLogger(__name__)
+
+_REFERENCE_NAME = "combo_xcr_2024-03-05"
+_REFERENCE_URL = (
+    "https://raw.githubusercontent.com/kmayerb/tcrdist3/refs/heads/master/"
+    f"tcrdist/db/{_REFERENCE_NAME}.tsv"
 )
+_REFERENCE_COLUMNS = ['organism', 'chain', 'region', 'id', 'aligned_protseq', 'cdrs']
+_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "tcrshuffler")
+# Bump whenever _REFERENCE_COLUMNS or the cached dict layout changes, so an
+# old pickle is never reused for a new format
+_CACHE_FORMAT = 1
 
 
-def load_reference(organism="human", chain="B"):
+@functools.lru_cache(maxsize=None)
+def _read_reference_dict():
+    """
+    Build the nested germline reference dict, using an on-disk pickle cache.
+
+    The first call downloads and parses the reference TSV and writes the
+    resulting dict to ``~/.cache/tcrshuffler/<reference>.v<format>.pkl``;
+    later calls (including from other processes) load the pickle instead.
+    A cache file that cannot be read is ignored and rewritten.
+
+    Returns
+    -------
+    dict
+        Germline records organized as d[organism][chain][region][gene_id].
+    """
+    cache_path = os.path.join(_CACHE_DIR, f"{_REFERENCE_NAME}.v{_CACHE_FORMAT}.pkl")
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as fh:
+                return pickle.load(fh)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+                ImportError, IndexError, TypeError, ValueError):
+            logger.warning("Ignoring unreadable reference cache %s", cache_path)
+
+    all_genes = pd.read_csv(
+        _REFERENCE_URL,
+        sep="\t",
+        usecols=_REFERENCE_COLUMNS,
+        dtype='category'
+    )
+
+    d = dict()
+    for r in all_genes.to_dict('records'):
+        org = r['organism']
+        ch = r['chain']
+        region = r['region']
+        gene_id = r['id']
+        d.setdefault(org, {}).setdefault(ch, {}).setdefault(region, {})[gene_id] = r
+
+    # The cache is only an optimization; an unwritable home directory is not an error
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as fh:
+            pickle.dump(d, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+    return d
+
+
+@functools.lru_cache(maxsize=None)
+def _load_germline_cdr3s(organism, chain):
+    """
+    Extract the CDR3 portion of every V and J germline for one organism/chain.
+
+    Returns
+    -------
+    tuple
+        (v_germline, j_germline) dicts mapping gene id to the last
+        ';'-delimited field of its 'cdrs' annotation.
+    """
+    d, _ = load_reference(organism=organism, chain=chain)
+    v_germline, j_germline = [
+        {
+            gene_id: rec['cdrs'].rsplit(";", 1)[-1]
+            for gene_id, rec in d.get(organism, {}).get(chain, {}).get(region, {}).items()
+            if isinstance(rec['cdrs'], str)
+        }
+        for region in ('V', 'J')
+    ]
+    return v_germline, j_germline
+
+
+@functools.lru_cache(maxsize=None)
+def _load_d_index(organism, chain):
+    """
+    Build the D segment index for one organism/chain (empty if it has no D genes).
+    """
+    _, D_genes = load_reference(organism=organism, chain=chain)
+    return build_d_index(D_genes or {})
+
+
+def _gene_categories(genes):
+    """
+    Code a V or J gene column by its distinct values.
+
+    Returns
+    -------
+    tuple
+        (codes, names, is_str) where, for row i, names[codes[i]] is its gene
+        with the default allele added and is_str[codes[i]] is whether it held
+        a string. Missing values get code -1, which indexes a trailing
+        non-string placeholder.
+    """
+    genes = pd.Categorical(genes)
+    names = np.append(genes.categories.to_numpy(dtype=object), None)
+    is_str = np.array([isinstance(name, str) for name in names], dtype=bool)
+    names[is_str] = _with_default_allele(pd.Series(names[is_str], dtype=object)).to_numpy()
+    return genes.codes, names, is_str
+
+
+def _with_default_allele(genes):
+    """
+    Append the default '*01' allele to gene names that lack one.
+
+    Only the rows without an allele are touched, so fully annotated input
+    costs a single vectorized contains() pass.
+    """
+    no_allele = ~genes.str.contains("*", regex=False)
+    if no_allele.any():
+        genes = genes.copy()
+        genes[no_allele] = genes[no_allele] + "*01"
+    return genes
+
+
+def _load_reference_impl(organism="human", chain="B"):
     """
     Load reference germline sequences for TCR analysis.
+
+    Results are cached in memory per (organism, chain), and the parsed
+    reference is cached on disk under ``~/.cache/tcrshuffler/``, so repeated
+    calls do not re-download or re-parse the reference table. The returned
+    dicts are shared by every caller; copy them before modifying.
     
     Parameters
     ----------
@@ -28,27 +164,19 @@ def load_reference(organism="human", chain="B"):
         germline sequences organized by organism/chain/region and D_genes_dict
         contains D gene sequences (None for alpha chain).
     """
-    all_genes = pd.read_csv(
-        'https://raw.githubusercontent.com/kmayerb/tcrdist3/refs/heads/master/tcrdist/db/combo_xcr_2024-03-05.tsv',
-        sep="\t"
-    )
-    
-    d = dict()
-    for i, r in all_genes.iterrows():
-        org = r['organism']
-        ch = r['chain']
-        region = r['region']
-        gene_id = r['id']
-        d.setdefault(org, {}).setdefault(ch, {}).setdefault(region, {})[gene_id] = r.to_dict()
-    
+    d = _read_reference_dict()
+
     if chain == "B":
         D_genes = {x['id']: x['aligned_protseq'] for x in d[organism][chain]['D'].values()}
     else:
         D_genes = None
-        
+
     return d, D_genes
 
 
+load_reference = functools.lru_cache(maxsize=8)(_load_reference_impl)
+
+
 def shuffle(tcrs,
             chain="B",
             organism="human", 
@@ -89,7 +217,8 @@ def shuffle(tcrs,
     depth : int, optional
         Sampling depth multiplier. Default is 2.
     random_seed : int, optional
-        Seed for random number generation. Default is 1.
+        Seed for the NumPy random generator used for cutpoints and shuffling.
+        None seeds from fresh OS entropy. Default is 1.
     return_presuffled : bool, optional
         If True, return pre-shuffle analysis instead of shuffled sequences. Default is False.
     return_errors : bool, optional
@@ -100,95 +229,131 @@ def shuffle(tcrs,
     pd.DataFrame
         DataFrame containing shuffled TCR sequences or analysis results based on parameters.
     """
-    d, D_genes = load_reference(chain=chain, organism=organism)
+    v_germline, j_germline = _load_germline_cdr3s(organism, chain)
+    d_index = _load_d_index(organism, chain)
     
-    if random_seed is not None:
-        random.seed(random_seed)
+    rng = np.random.default_rng(random_seed)
         
-    sequences = list(tcrs[[v_col, cdr3_col, j_col]].itertuples(index=False, name=None))
-    store_v = []
-    store_d = []
-    store_j = []
     error_cdr3 = []
-    presuffled_receptors = []
-
-    # Process each sequence
-    for v, cdr3, j in sequences * depth:
-        if not all(isinstance(x, str) for x in (v, cdr3, j)):
-            error_cdr3.append((v, cdr3, j, "invalid_types"))
-            continue
-            
-        # Ensure allele notation
-        if v.find("*") == -1:
-            v = f"{v}*01"
-        if j.find("*") == -1:
-            j = f"{j}*01"
-        
-        try:
-            germline_v = d[organism][chain]['V'][v]['cdrs'].split(";")[-1]
-            germline_j = d[organism][chain]['J'][j]['cdrs'].split(";")[-1]
-        except KeyError as e:
-            error_cdr3.append((v, cdr3, j, f"missing_germline_{e}"))
-            continue
-        
-        cdr3_source = label_cdr3_germline_vj_regions(cdr3, germline_v, germline_j)
-        
-        if chain == "B":
-            cdr3, cdr3_source, d_gene = best_d_alignment(cdr3, cdr3_source, D_genes)
-        else:
-            d_gene = None
-            
-        cutpoints = choose_cutpoints_around_d(cdr3_source)
-        
-        if cutpoints is None:
-            error_cdr3.append((v, cdr3, j, cdr3_source))
-            continue
 
-        cut1, cut2 = cutpoints
-        
-        if cut1 is None:
-            error_cdr3.append((v, cdr3, j, cdr3_source))
-            continue
+    # V and J genes take few distinct values, so they are type-checked,
+    # given a default allele and resolved to germlines once per category
+    vs, cdr3s, js = tcrs[v_col], tcrs[cdr3_col], tcrs[j_col]
+    v_codes, v_names, v_is_str = _gene_categories(vs)
+    j_codes, j_names, j_is_str = _gene_categories(js)
 
-        v_part = cdr3[:cut1+1]
-        d_part = cdr3[cut1+1:cut2+1]
-        j_part = cdr3[cut2+1:]
-        
-        store_v.append((v, v_part))
-        store_d.append((d_gene, d_part))
-        store_j.append((j, j_part))
+    is_str = (
+        v_is_str[v_codes] &
+        cdr3s.apply(isinstance, args=(str,)).to_numpy(dtype=bool) &
+        j_is_str[j_codes]
+    )
+    invalid_types = [
+        (v, cdr3, j, "invalid_types")
+        for v, cdr3, j in zip(vs[~is_str], cdr3s[~is_str], js[~is_str])
+    ]
+    error_cdr3.extend(invalid_types * depth)
+    v_codes, cdr3s, j_codes = v_codes[is_str], cdr3s[is_str], j_codes[is_str]
 
-        cut_cdr3 = cdr3[:cut1+1] + "--" + cdr3[cut1+1:cut2+1].lower() + "--" + cdr3[cut2+1:]
-        presuffled_receptors.append((
-            v, j, germline_v, germline_j, cdr3, cdr3_source, 
-            cut1, cut2, cut_cdr3, v_part, d_part, j_part
-        ))
+    v_lookup = np.array([v_germline.get(g) for g in v_names], dtype=object)
+    j_lookup = np.array([j_germline.get(g) for g in j_names], dtype=object)
+
+    # Rows whose V or J gene has no germline fail up front
+    has_v = np.array([g in v_germline for g in v_names], dtype=bool)[v_codes]
+    valid = has_v & np.array([g in j_germline for g in j_names], dtype=bool)[j_codes]
+    missing_germlines = [
+        (v, cdr3, j, f"missing_germline_{j if v_found else v!r}")
+        for v, cdr3, j, v_found in zip(
+            v_names[v_codes[~valid]], cdr3s[~valid], j_names[j_codes[~valid]], has_v[~valid]
+        )
+    ]
+    error_cdr3.extend(missing_germlines * depth)
+    v_codes, cdr3s, j_codes = v_codes[valid], cdr3s[valid], j_codes[valid]
+
+    v_arr = v_names[v_codes]
+    cdr3_arr = cdr3s.to_numpy(dtype=object)
+    j_arr = j_names[j_codes]
+    n = len(v_arr)
+
+    # Label each distinct (cdr3, V, J) input once, in one batched pass
+    row_keys, _ = pd.MultiIndex.from_arrays([cdr3_arr, v_codes, j_codes]).factorize()
+    first_rows = np.unique(row_keys, return_index=True)[1]
+    (cdr3_sources, _, before_indptr, cuts_before,
+     after_indptr, cuts_after) = label_and_find_d_batch(
+        cdr3_arr[first_rows], v_lookup[v_codes[first_rows]],
+        j_lookup[j_codes[first_rows]], d_index
+    )
+    cdr3_sources = np.asarray(cdr3_sources, dtype=object)
+
+    # The only per-sequence failure: no valid cut on one side of D
+    cuttable = ((np.diff(before_indptr) > 0) & (np.diff(after_indptr) > 0))[row_keys]
+    uncut = np.flatnonzero(~cuttable)
+    error_cdr3.extend(list(zip(
+        v_arr[uncut], cdr3_arr[uncut], j_arr[uncut], cdr3_sources[row_keys[uncut]]
+    )) * depth)
+
+    # One pair of uniform draws per sequence and depth picks its cutpoints;
+    # outputs are laid out depth-major, one pass over the inputs per depth
+    cut_draws = rng.random((depth, n, 2))[:, cuttable].reshape(-1, 2)
+    rows = np.tile(np.flatnonzero(cuttable), depth)
+    keys = row_keys[rows]
+    cut1 = sample_cutpoints(before_indptr, cuts_before, keys, cut_draws[:, 0])
+    cut2 = sample_cutpoints(after_indptr, cuts_after, keys, cut_draws[:, 1])
 
     # Handle return options
     failure_rate = len(error_cdr3) / (len(tcrs) * depth)
-    print(f"failure_rate: {failure_rate}")
+    logger.info("failure_rate: %s", failure_rate)
     
     if return_errors:
         return error_cdr3
+
+    # Split every sample at its cutpoints into preallocated object columns,
+    # which concatenate element-wise without fixed-width string copies
+    n_out = len(rows)
+    cdr3_out = cdr3_arr[rows]
+    cut1_list, cut2_list, cdr3_list = cut1.tolist(), cut2.tolist(), cdr3_out.tolist()
+    v_parts = np.empty(n_out, dtype=object)
+    d_parts = np.empty(n_out, dtype=object)
+    j_parts = np.empty(n_out, dtype=object)
+    v_parts[:] = [cdr3[:c1 + 1] for cdr3, c1 in zip(cdr3_list, cut1_list)]
+    d_parts[:] = [cdr3[c1 + 1:c2 + 1] for cdr3, c1, c2 in zip(cdr3_list, cut1_list, cut2_list)]
+    j_parts[:] = [cdr3[c2 + 1:] for cdr3, c2 in zip(cdr3_list, cut2_list)]
         
     if return_presuffled:
-        df = pd.DataFrame(presuffled_receptors, columns=[
-            'v', 'j', 'germline_v', 'germline_j', 'cdr3', 'cdr3_source', 
-            'cut1', 'cut2', 'cut_cdr3', 'v_part', 'd_part', 'j_part'
-        ])
+        d_lower = np.empty(n_out, dtype=object)
+        d_lower[:] = [d_part.lower() for d_part in d_parts.tolist()]
+
+        # Build from whole columns so pandas does not re-scan row tuples
+        df = pd.DataFrame({
+            'v': v_arr[rows],
+            'j': j_arr[rows],
+            'germline_v': v_lookup[v_codes[rows]],
+            'germline_j': j_lookup[j_codes[rows]],
+            'cdr3': cdr3_out,
+            'cdr3_source': cdr3_sources[keys],
+            'cut1': cut1,
+            'cut2': cut2,
+            'cut_cdr3': v_parts + "--" + d_lower + "--" + j_parts,
+            'v_part': v_parts,
+            'd_part': d_parts,
+            'j_part': j_parts,
+        }, copy=False)
         return df
 
-    # Shuffle components
-    random.shuffle(store_v)
-    random.shuffle(store_d)
-    random.shuffle(store_j)
+    # Shuffle components as parallel arrays, one permutation per segment
+    perm_v, perm_d, perm_j = (
+        rng.permutation(n_out), rng.permutation(n_out), rng.permutation(n_out)
+    )
+    v_genes = v_arr[rows[perm_v]]
+    v_parts = v_parts[perm_v]
+    d_parts = d_parts[perm_d]
+    j_genes = j_arr[rows[perm_j]]
+    j_parts = j_parts[perm_j]
 
-    # Combine into new sequences
-    new_junctions = [
-        (V, n + dseg + c, J, (n, dseg, c))
-        for (V, n), (D, dseg), (J, c) in zip(store_v, store_d, store_j)
-    ]
-    
     # Output as DataFrame
-    df = pd.DataFrame(new_junctions, columns=[v_col, cdr3_col, j_col, 'components'])
-    return df
\ No newline at end of file
+    df = pd.DataFrame({
+        v_col: v_genes,
+        cdr3_col: v_parts + d_parts + j_parts,
+        j_col: j_genes,
+        'components': list(zip(v_parts.tolist(), d_parts.tolist(), j_parts.tolist())),
+    }, copy=False)
+    return df
@@ -1,8 +1,75 @@
 """
 Utility functions for TCR sequence analysis and manipulation.
 """
-import random
-from difflib import SequenceMatcher
+from collections import namedtuple
+from itertools import chain
+
+import numpy as np
+
+try:
+    from numba import njit
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+_V, _N, _D, _J = ord('V'), ord('N'), ord('D'), ord('J')
+
+DIndex = namedtuple('DIndex', [
+    'seqs', 'substrings', 'buf', 'offsets', 'lens',
+    'anchor_offsets', 'anchors', 'anchor_segments'
+])
+
+# Allowed (left, right) label transitions for cutpoints
+_VALID_PAIRS = frozenset({('V', 'N'), ('N', 'D'), ('D', 'N'), ('D', 'J')})
+_BEFORE_D_PAIRS = frozenset({('V', 'N'), ('N', 'D'), ('V', 'D'), ('V', 'J')})
+_AFTER_D_PAIRS = frozenset({('D', 'N'), ('D', 'J'), ('N', 'J'), ('V', 'J')})
+
+# For the compiled kernels, region labels are coded 0-3 (anything else is 4)
+# so that a (left, right) transition packs into 6 bits and a set of
+# transitions into one int bitmask
+_LABEL_CODE = np.full(256, 4, dtype=np.uint8)
+for _code, _label in enumerate('VNDJ'):
+    _LABEL_CODE[ord(_label)] = _code
+
+
+def _transition_mask(transitions):
+    mask = 0
+    for a, b in transitions:
+        mask |= 1 << ((int(_LABEL_CODE[ord(a)]) << 3) | int(_LABEL_CODE[ord(b)]))
+    return mask
+
+
+_VALID_TRANSITIONS = _transition_mask(_VALID_PAIRS)
+_BEFORE_D_TRANSITIONS = _transition_mask(_BEFORE_D_PAIRS)
+_AFTER_D_TRANSITIONS = _transition_mask(_AFTER_D_PAIRS)
+
+_rng = np.random.default_rng()
+
+
+def _as_u8(s):
+    """Return an ASCII string as a read-only uint8 array; arrays pass through."""
+    if isinstance(s, np.ndarray):
+        return s
+    return np.frombuffer(s.encode('ascii'), dtype=np.uint8)
+
+
+def _d_arrays(d_index):
+    """The packed D catalog arrays of a DIndex, in the order kernels take them."""
+    return (
+        d_index.buf, d_index.offsets, d_index.lens,
+        d_index.anchor_offsets, d_index.anchors, d_index.anchor_segments
+    )
+
+
+def _pack(strings):
+    """
+    Pack ASCII strings into one uint8 buffer, with string i at
+    buf[offsets[i]:offsets[i + 1]].
+    """
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, strings), dtype=np.int64, count=len(strings)),
+              out=offsets[1:])
+    return _as_u8(''.join(strings)), offsets
 
 
 def label_cdr3_germline_vj_regions(cdr3, germline_v, germline_j):
@@ -26,18 +93,23 @@ def label_cdr3_germline_vj_regions(cdr3, germline_v, germline_j):
         - 'J' where cdr3 matches germline_j
         - 'N' otherwise (non-templated nucleotide additions)
     """
-    labels = list('N' * len(cdr3))
+    n = len(cdr3)
+    labels = ['N'] * n
 
     # Match from left with germline_v
+    v_prefix = 0
     for i, aa in enumerate(germline_v):
-        if i >= len(cdr3):
+        if i >= n:
             break
         if aa == cdr3[i]:
             labels[i] = 'V'
+            if v_prefix == i:
+                v_prefix = i + 1
 
-    # Match from right with germline_j
+    # Match from right with germline_j, without overwriting V matches. The
+    # leading run of V matches can never become J, so the scan stops there.
     for j, aa in enumerate(reversed(germline_j)):
-        if j >= len(cdr3):
+        if j >= n - v_prefix:
             break
         if aa == cdr3[-(j+1)]:
             if labels[-(j+1)] == 'N':  # don't overwrite V matches
@@ -46,10 +118,58 @@ def label_cdr3_germline_vj_regions(cdr3, germline_v, germline_j):
     return ''.join(labels)
 
 
-def best_d_alignment(cdr3, cdr3_source, d_segments, min_v=4, min_j=3):
+def build_d_index(d_segments):
+    """
+    Index every substring of every D segment.
+
+    Parameters
+    ----------
+    d_segments : dict
+        Dictionary of D gene names to amino acid sequences.
+
+    Returns
+    -------
+    DIndex
+        Named tuple with fields:
+        - seqs: list of D sequences in dictionary order
+        - substrings: dict mapping every substring of every D sequence to the
+          lowest d_number it occurs in
+        - buf, offsets: the D sequences packed into one uint8 array, with
+          sequence d_number at buf[offsets[d_number]:offsets[d_number + 1]]
+        - lens: int32 array of D sequence lengths
+        - anchor_offsets, anchors, anchor_segments: every position in buf
+          grouped by residue, with the positions of byte b (in D order) at
+          anchors[anchor_offsets[b]:anchor_offsets[b + 1]] and their D
+          numbers at the same slice of anchor_segments
+    """
+    d_seqs = list(d_segments.values())
+    substrings = dict()
+    for d_number, d_seq in enumerate(d_seqs):
+        for start in range(len(d_seq)):
+            for end in range(start + 1, len(d_seq) + 1):
+                substrings.setdefault(d_seq[start:end], d_number)
+    buf, offsets = _pack(d_seqs)
+    lens = np.diff(offsets).astype(np.int32)
+    anchors = np.argsort(buf, kind='stable')
+    anchor_offsets = np.zeros(257, dtype=np.int64)
+    np.cumsum(np.bincount(buf, minlength=256), out=anchor_offsets[1:])
+    anchor_segments = np.repeat(np.arange(len(d_seqs)), lens)[anchors]
+    return DIndex(
+        d_seqs, substrings, buf, offsets, lens,
+        anchor_offsets, anchors, anchor_segments
+    )
+
+
+def best_d_alignment(cdr3, cdr3_source, d_segments, min_v=4, min_j=3, d_index=None):
     """
     Try to assign a D gene match in the central region of the CDR3.
 
+    The longest common substring between the CDR3 core and any D segment is
+    found by looking up core substrings, longest first, in a hash of all D
+    substrings, so every D segment is scored in the same pass. Ties are
+    broken the same way as difflib.SequenceMatcher.find_longest_match:
+    earliest D segment, then earliest position in the core.
+
     Parameters
     ----------
     cdr3 : str
@@ -62,6 +182,9 @@ def best_d_alignment(cdr3, cdr3_source, d_segments, min_v=4, min_j=3):
         Number of residues to preserve at N-terminus from V. Default is 4.
     min_j : int, optional
         Number of residues to preserve at C-terminus from J. Default is 3.
+    d_index : DIndex, optional
+        Precomputed result of build_d_index(d_segments). Built on the fly if
+        not provided.
 
     Returns
     -------
@@ -69,23 +192,42 @@ def best_d_alignment(cdr3, cdr3_source, d_segments, min_v=4, min_j=3):
         (cdr3, modified_cdr3_source, best_d_sequence) where modified_cdr3_source
         has D regions annotated and best_d_sequence is the best matching D gene.
     """
+    if d_index is None:
+        d_index = build_d_index(d_segments)
+    d_seqs, substrings = d_index.seqs, d_index.substrings
+
+    if _NUMBA_AVAILABLE:
+        core_start, core_end, _ = slice(min_v, len(cdr3) - min_j).indices(len(cdr3))
+        best_number, best_score, best_pos = _best_d_njit(
+            _as_u8(cdr3), core_start, core_end, _d_arrays(d_index)
+        )
+        if best_number < 0:
+            return cdr3, cdr3_source, None
+        end = best_pos + best_score
+        modified_source = cdr3_source[:best_pos] + 'D' * best_score + cdr3_source[end:]
+        return cdr3, modified_source, d_seqs[best_number]
+
     core = cdr3[min_v:len(cdr3)-min_j]
-    best_match = None
     best_score = 0
-    best_d = None
+    best_number = None
+    best_pos = None
 
-    for name, d_seq in d_segments.items():
-        match = SequenceMatcher(None, core, d_seq).find_longest_match(
-            0, len(core), 0, len(d_seq)
-        )
-        if match.size > best_score:
-            best_score = match.size
-            best_match = match
-            best_d = d_seq
-
-    if best_match and best_score > 0:
-        start = min_v + best_match.a
-        end = start + best_match.size
+    max_size = min(len(core), max((len(d_seq) for d_seq in d_seqs), default=0))
+    for size in range(max_size, 0, -1):
+        for i in range(len(core) - size + 1):
+            d_number = substrings.get(core[i:i + size])
+            if d_number is not None and (best_number is None or d_number < best_number):
+                best_number = d_number
+                best_pos = i
+        if best_number is not None:
+            best_score = size
+            break
+
+    best_d = d_seqs[best_number] if best_number is not None else None
+
+    if best_score > 0:
+        start = min_v + best_pos
+        end = start + best_score
         modified_source = (
             cdr3_source[:start] + 
             "".join(['D' for x in cdr3_source[start:end]]) + 
@@ -96,7 +238,18 @@ def best_d_alignment(cdr3, cdr3_source, d_segments, min_v=4, min_j=3):
         return cdr3, cdr3_source, best_d  # no match found
 
 
-def choose_valid_cutpoint(label_string):
+def _transition_positions(label_string, transitions):
+    """
+    Return indices i where (label_string[i], label_string[i+1]) is in the
+    set of transitions.
+    """
+    return [
+        i for i, pair in enumerate(zip(label_string, label_string[1:]))
+        if pair in transitions
+    ]
+
+
+def choose_valid_cutpoint(label_string, rng=None):
     """
     Select a random valid cutpoint between specific region transitions in a label string.
 
@@ -104,6 +257,8 @@ def choose_valid_cutpoint(label_string):
     ----------
     label_string : str
         String of region labels (e.g., 'VVVVVNDJJJJJJ').
+    rng : numpy.random.Generator, optional
+        Random generator to sample with. Defaults to a module-level generator.
 
     Returns
     -------
@@ -111,15 +266,18 @@ def choose_valid_cutpoint(label_string):
         Index `i` such that the cutpoint is between label_string[i] and label_string[i+1].
         Returns None if no valid cutpoints are found.
     """
-    valid_transitions = {('V', 'N'), ('N', 'D'), ('D', 'N'), ('D', 'J')}
-    cutpoints = [
-        i for i in range(len(label_string) - 1)
-        if (label_string[i], label_string[i + 1]) in valid_transitions
-    ]
-    return random.choice(cutpoints) if cutpoints else None
+    rng = _rng if rng is None else rng
+    if _NUMBA_AVAILABLE:
+        labels = _as_u8(label_string)
+        cutpoints = np.empty(len(labels), dtype=np.int64)
+        n_cuts = _transitions_njit(labels, _VALID_TRANSITIONS, 0, len(labels) - 1, cutpoints)
+        cutpoints = cutpoints[:n_cuts]
+    else:
+        cutpoints = _transition_positions(label_string, _VALID_PAIRS)
+    return int(cutpoints[rng.integers(len(cutpoints))]) if len(cutpoints) else None
 
 
-def choose_cutpoints_around_d(label_string):
+def choose_cutpoints_around_d(label_string, rng=None):
     """
     Select one valid cutpoint before D and one after D in a labeled region string.
 
@@ -130,6 +288,8 @@ def choose_cutpoints_around_d(label_string):
     ----------
     label_string : str
         String of region labels (e.g., 'VVVVVNDJJJJJJ').
+    rng : numpy.random.Generator, optional
+        Random generator to sample with. Defaults to a module-level generator.
 
     Returns
     -------
@@ -139,23 +299,324 @@ def choose_cutpoints_around_d(label_string):
         - cut_after is between transitions like 'D|N', 'D|J', 'N|J', or 'V|J'
         Returns None if valid cutpoints cannot be found.
     """
-    # Define allowed transitions
-    before_d = {('V', 'N'), ('N', 'D'), ('V', 'D'), ('V', 'J')}
-    after_d = {('D', 'N'), ('D', 'J'), ('N', 'J'), ('V', 'J')}
+    rng = _rng if rng is None else rng
+    u_before, u_after = rng.random(2)
+    cuts_before, cuts_after = _cutpoints_around_d(label_string)
+    if not cuts_before or not cuts_after:
+        return None
+    return (
+        cuts_before[int(u_before * len(cuts_before))],
+        cuts_after[int(u_after * len(cuts_after))]
+    )
 
-    cuts_before = [
-        i for i in range(1, len(label_string) - 1)
-        if (label_string[i], label_string[i + 1]) in before_d
-    ]
-    cuts_after = [
-        i for i in range(len(label_string) - 2)
-        if (label_string[i], label_string[i + 1]) in after_d
+
+def _cutpoints_around_d(label_string):
+    """
+    All candidate cutpoints before and after D, as two tuples of ints.
+    """
+    if _NUMBA_AVAILABLE:
+        labels = _as_u8(label_string)
+        cuts_before = np.empty(len(labels), dtype=np.int64)
+        cuts_after = np.empty(len(labels), dtype=np.int64)
+        n_before, n_after = _cuts_njit(labels, cuts_before, cuts_after)
+        return tuple(cuts_before[:n_before].tolist()), tuple(cuts_after[:n_after].tolist())
+
+    cuts_before = _transition_positions(label_string, _BEFORE_D_PAIRS)
+    cuts_after = _transition_positions(label_string, _AFTER_D_PAIRS)
+
+    # A cut before D may not leave the V part empty; a cut after D may not
+    # leave the J part empty
+    return (
+        tuple(i for i in cuts_before if i >= 1),
+        tuple(i for i in cuts_after if i < len(label_string) - 2)
+    )
+
+
+def label_and_find_d(cdr3, germline_v, germline_j, d_index, min_v=4, min_j=3):
+    """
+    Label a CDR3, assign its best D match and list its cutpoints around D.
+
+    This fuses label_cdr3_germline_vj_regions, best_d_alignment and the
+    deterministic part of choose_cutpoints_around_d: every candidate cutpoint
+    is returned, and callers pick from them with their own random draws.
+    When numba is installed it runs in one compiled kernel; otherwise the
+    pure-Python functions are used. Both paths give identical results.
+
+    Parameters
+    ----------
+    cdr3 : str
+        The full CDR3 amino acid sequence.
+    germline_v : str
+        The germline V region amino acid string aligned to the start of the CDR3.
+    germline_j : str
+        The germline J region amino acid string aligned to the end of the CDR3.
+    d_index : DIndex
+        Result of build_d_index() for the D segments to align against. Use an
+        index of no segments for chains without D genes.
+    min_v : int, optional
+        Number of residues to preserve at N-terminus from V. Default is 4.
+    min_j : int, optional
+        Number of residues to preserve at C-terminus from J. Default is 3.
+
+    Returns
+    -------
+    tuple
+        (cdr3_source, d_gene, cuts_before, cuts_after) where cdr3_source holds
+        the V/N/D/J labels, d_gene is the best matching D sequence (or None)
+        and cuts_before/cuts_after are tuples of the valid cutpoints on each
+        side of D.
+    """
+    if _NUMBA_AVAILABLE:
+        labels, d_number, cuts_before, cuts_after = _label_and_find_d_kernel(
+            _as_u8(cdr3), _as_u8(germline_v), _as_u8(germline_j),
+            _d_arrays(d_index), min_v, min_j
+        )
+        cdr3_source = labels.tobytes().decode('ascii')
+        d_gene = d_index.seqs[d_number] if d_number >= 0 else None
+        return cdr3_source, d_gene, tuple(cuts_before.tolist()), tuple(cuts_after.tolist())
+
+    cdr3_source = label_cdr3_germline_vj_regions(cdr3, germline_v, germline_j)
+    _, cdr3_source, d_gene = best_d_alignment(
+        cdr3, cdr3_source, None, min_v=min_v, min_j=min_j, d_index=d_index
+    )
+    return (cdr3_source, d_gene) + _cutpoints_around_d(cdr3_source)
+
+
+def label_and_find_d_batch(cdr3s, germline_vs, germline_js, d_index, min_v=4, min_j=3):
+    """
+    Run label_and_find_d over whole arrays of CDR3s and their germlines.
+
+    The inputs are packed into flat uint8 buffers and, when numba is
+    installed, every row is processed by one compiled kernel.
+    Otherwise label_and_find_d is called row by row. Both paths give
+    identical results.
+
+    Parameters
+    ----------
+    cdr3s : sequence of str
+        The full CDR3 amino acid sequences.
+    germline_vs : sequence of str
+        The germline V region of each CDR3.
+    germline_js : sequence of str
+        The germline J region of each CDR3.
+    d_index : DIndex
+        Result of build_d_index() for the D segments to align against.
+    min_v : int, optional
+        Number of residues to preserve at N-terminus from V. Default is 4.
+    min_j : int, optional
+        Number of residues to preserve at C-terminus from J. Default is 3.
+
+    Returns
+    -------
+    tuple
+        (cdr3_sources, d_genes, before_indptr, cuts_before, after_indptr,
+        cuts_after) where cdr3_sources and d_genes are lists as returned by
+        label_and_find_d for each row, and the candidate cutpoints are in CSR
+        form: those of row i before D are
+        cuts_before[before_indptr[i]:before_indptr[i + 1]], and likewise
+        after D.
+    """
+    if _NUMBA_AVAILABLE:
+        cdr3_buf, offsets = _pack(cdr3s)
+        v_buf, v_offsets = _pack(germline_vs)
+        j_buf, j_offsets = _pack(germline_js)
+        n = len(offsets) - 1
+        labels = np.empty(len(cdr3_buf), dtype=np.uint8)
+        d_numbers = np.empty(n, dtype=np.int64)
+        # The kernel writes each row's candidates at that row's CDR3 offset
+        cuts_before = np.empty(len(cdr3_buf), dtype=np.int64)
+        cuts_after = np.empty(len(cdr3_buf), dtype=np.int64)
+        n_before = np.empty(n, dtype=np.int64)
+        n_after = np.empty(n, dtype=np.int64)
+        _label_all_njit(
+            cdr3_buf, offsets, v_buf, v_offsets, j_buf, j_offsets,
+            _d_arrays(d_index), min_v, min_j,
+            labels, d_numbers, cuts_before, n_before, cuts_after, n_after
+        )
+        labels = labels.tobytes().decode('ascii')
+        bounds = offsets.tolist()
+        cdr3_sources = [labels[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        d_genes = [d_index.seqs[k] if k >= 0 else None for k in d_numbers.tolist()]
+        return (
+            cdr3_sources, d_genes,
+            *_compact(cuts_before, offsets, n_before),
+            *_compact(cuts_after, offsets, n_after)
+        )
+
+    rows = [
+        label_and_find_d(cdr3, germline_v, germline_j, d_index, min_v=min_v, min_j=min_j)
+        for cdr3, germline_v, germline_j in zip(cdr3s, germline_vs, germline_js)
     ]
+    cdr3_sources = [row[0] for row in rows]
+    d_genes = [row[1] for row in rows]
+    return (
+        cdr3_sources, d_genes,
+        *_csr([row[2] for row in rows]),
+        *_csr([row[3] for row in rows])
+    )
 
-    if not cuts_before or not cuts_after:
-        return None
 
-    return (random.choice(cuts_before), random.choice(cuts_after))
+def _csr(rows):
+    """(indptr, indices) for a list of integer tuples."""
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, rows), dtype=np.int64, count=len(rows)), out=indptr[1:])
+    indices = np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=indptr[-1])
+    return indptr, indices
+
+
+def _compact(padded, offsets, counts):
+    """
+    (indptr, indices) for rows stored at padded[offsets[i]:offsets[i] + counts[i]].
+    """
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    shift = np.repeat(offsets[:-1] - indptr[:-1], counts)
+    return indptr, padded[shift + np.arange(indptr[-1])]
+
+
+def sample_cutpoints(indptr, cuts, rows, u):
+    """
+    Pick one candidate cutpoint per requested row of a CSR candidate table.
+
+    Parameters
+    ----------
+    indptr, cuts : numpy.ndarray
+        Candidate cutpoints in CSR form, as returned by label_and_find_d_batch.
+    rows : numpy.ndarray
+        Row of each pick; every row must have at least one candidate.
+    u : numpy.ndarray
+        Uniform draws in [0, 1), one per pick.
+
+    Returns
+    -------
+    numpy.ndarray
+        cuts[indptr[row] + int(u * n_candidates(row))] for each pick, the
+        same choice choose_cutpoints_around_d makes for a single sequence.
+    """
+    counts = indptr[rows + 1] - indptr[rows]
+    return cuts[indptr[rows] + (u * counts).astype(np.int64)]
+
+
+if _NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _label_njit(cdr3, germline_v, germline_j, out):
+        n = len(cdr3)
+        out[:] = _N
+
+        # V/J germline labels; the J scan stops at the leading run of V matches
+        v_prefix = 0
+        for i in range(min(len(germline_v), n)):
+            if cdr3[i] == germline_v[i]:
+                out[i] = _V
+                if v_prefix == i:
+                    v_prefix = i + 1
+        lj = len(germline_j)
+        for k in range(min(lj, n - v_prefix)):
+            if cdr3[n - 1 - k] == germline_j[lj - 1 - k] and out[n - 1 - k] == _N:
+                out[n - 1 - k] = _J
+
+    @njit(cache=True)
+    def _best_d_njit(cdr3, core_start, core_end, d_arrays):
+        # Longest common substring of cdr3[core_start:core_end] with any D
+        # segment, as (d_number, size, position) with d_number -1 if none
+        d_buf, d_offsets, d_lens, anchor_offsets, anchors, anchor_segments = d_arrays
+        best_score = 0
+        best_number = -1
+        best_pos = 0
+        for i in range(core_start, core_end):
+            # Only D positions holding this residue can start a common run
+            residue = cdr3[i]
+            for a in range(anchor_offsets[residue], anchor_offsets[residue + 1]):
+                offset = anchors[a]
+                d_number = anchor_segments[a]
+                d_start = d_offsets[d_number]
+                # Only extend from the left edge of each common run
+                if i > core_start and offset > d_start and cdr3[i - 1] == d_buf[offset - 1]:
+                    continue
+                max_size = min(core_end - i, d_start + d_lens[d_number] - offset)
+                size = 1
+                while size < max_size and cdr3[i + size] == d_buf[offset + size]:
+                    size += 1
+                if size > best_score or (size == best_score and d_number < best_number):
+                    best_score = size
+                    best_number = d_number
+                    best_pos = i
+        return best_number, best_score, best_pos
+
+    @njit(cache=True)
+    def _find_d_njit(cdr3, labels, d_arrays, min_v, min_j):
+        n = len(cdr3)
+
+        # Core bounds with Python slice semantics for cdr3[min_v:n - min_j]
+        core_start = min_v + n if min_v < 0 else min_v
+        core_start = min(max(core_start, 0), n)
+        core_end = n - min_j
+        core_end = core_end + n if core_end < 0 else core_end
+        core_end = min(max(core_end, 0), n)
+
+        best_number, best_score, best_pos = _best_d_njit(cdr3, core_start, core_end, d_arrays)
+        for p in range(best_pos, best_pos + best_score):
+            labels[p] = _D
+        return best_number
+
+    @njit(cache=True)
+    def _transitions_njit(labels, transitions, start, stop, out):
+        # Positions i in [start, stop) where labels[i:i + 2] is in transitions
+        n_out = 0
+        for i in range(start, stop):
+            if _has_transition(transitions, labels[i], labels[i + 1]):
+                out[n_out] = i
+                n_out += 1
+        return n_out
+
+    @njit(cache=True)
+    def _cuts_njit(labels, cuts_before, cuts_after):
+        # Candidate cutpoints on each side of D
+        n = len(labels)
+        n_before = _transitions_njit(labels, _BEFORE_D_TRANSITIONS, 1, n - 1, cuts_before)
+        n_after = _transitions_njit(labels, _AFTER_D_TRANSITIONS, 0, n - 2, cuts_after)
+        return n_before, n_after
+
+    @njit(cache=True)
+    def _label_and_find_d_kernel(cdr3, germline_v, germline_j, d_arrays, min_v, min_j):
+        n = len(cdr3)
+        labels = np.empty(n, dtype=np.uint8)
+        _label_njit(cdr3, germline_v, germline_j, labels)
+        best_number = _find_d_njit(cdr3, labels, d_arrays, min_v, min_j)
+        cuts_before = np.empty(n, dtype=np.int64)
+        cuts_after = np.empty(n, dtype=np.int64)
+        n_before, n_after = _cuts_njit(labels, cuts_before, cuts_after)
+        return labels, best_number, cuts_before[:n_before], cuts_after[:n_after]
+
+    @njit(cache=True)
+    def _label_all_njit(cdr3_buf, offsets, v_buf, v_offsets, j_buf, j_offsets,
+                        d_arrays, min_v, min_j,
+                        labels, d_numbers, cuts_before, n_before, cuts_after, n_after):
+        for i in range(len(offsets) - 1):
+            start, end = offsets[i], offsets[i + 1]
+            cdr3 = cdr3_buf[start:end]
+            row_labels = labels[start:end]
+            _label_njit(
+                cdr3, v_buf[v_offsets[i]:v_offsets[i + 1]],
+                j_buf[j_offsets[i]:j_offsets[i + 1]], row_labels
+            )
+            d_numbers[i] = _find_d_njit(cdr3, row_labels, d_arrays, min_v, min_j)
+            row_before, row_after = _cuts_njit(
+                row_labels, cuts_before[start:end], cuts_after[start:end]
+            )
+            n_before[i] = row_before
+            n_after[i] = row_after
+
+    @njit(cache=True)
+    def _has_transition(transitions, a, b):
+        return (transitions >> ((np.int64(_LABEL_CODE[a]) << 3) | _LABEL_CODE[b])) & 1
+
+    # Compile on import so the first call does not pay for it
+    _label_njit(_as_u8('C'), _as_u8('C'), _as_u8('C'), np.empty(1, dtype=np.uint8))
+    label_and_find_d('CASSF', 'CAS', 'SF', build_d_index({'D': 'G'}))
+    label_and_find_d_batch(['CASSF'], ['CAS'], ['SF'], build_d_index({'D': 'G'}))
+    choose_valid_cutpoint('VNDJ', rng=np.random.default_rng(0))
+    choose_cutpoints_around_d('VNDJ', rng=np.random.default_rng(0))
 
 
 def center_pad(germline_v, germline_j, total_length, fill_char='.'):
@@ -187,4 +648,4 @@ def center_pad(germline_v, germline_j, total_length, fill_char='.'):
     middle_length = total_length - len(left) - len(right)
     middle = fill_char * middle_length if middle_length > 0 else ''
     
-    return left + middle + right
\ No newline at end of file
+    return left + middle + right
@@ -1,12 +1,20 @@
 """
 Tests for tcrshuffler package. -- Writen by Claude Sonnet not human tested yet!
 """
+import pickle
+
 import pytest
+import numpy as np
 import pandas as pd
 from tcrshuffler.core import shuffle, load_reference
+from tcrshuffler import core, utils
 from tcrshuffler.utils import (
     label_cdr3_germline_vj_regions,
+    label_and_find_d,
+    label_and_find_d_batch,
+    sample_cutpoints,
     best_d_alignment,
+    build_d_index,
     choose_valid_cutpoint,
     choose_cutpoints_around_d,
     center_pad
@@ -47,6 +55,24 @@ class TestUtils:
         assert "D" in result_source
         assert best_d in d_segments.values()
         
+    def test_best_d_alignment_with_index(self):
+        """Test D gene alignment with a precomputed index."""
+        cdr3 = "CASSSLAGGTEAFF"
+        cdr3_source = "VVVVNNNNNNJJJJ"
+        d_segments = {"TRBD1*01": "GGGAC", "TRBD2*01": "GLAGG"}
+        d_index = build_d_index(d_segments)
+
+        result = best_d_alignment(cdr3, cdr3_source, d_segments, d_index=d_index)
+        assert result == best_d_alignment(cdr3, cdr3_source, d_segments)
+        assert result == (cdr3, "VVVVNDDDDNJJJJ", "GLAGG")
+
+    def test_best_d_alignment_no_match(self):
+        """Test D gene alignment when no residue is shared."""
+        cdr3 = "CASSWWWWEAFF"
+        cdr3_source = "VVVVNNNNJJJJ"
+        result = best_d_alignment(cdr3, cdr3_source, {"TRBD1*01": "GTGG"})
+        assert result == (cdr3, cdr3_source, None)
+
     def test_choose_valid_cutpoint(self):
         """Test cutpoint selection."""
         label_string = "VVVVNNNDDDDJJJJ"
@@ -69,6 +95,100 @@ class TestUtils:
             assert 0 <= cut1 < len(label_string) - 1
             assert 0 <= cut2 < len(label_string) - 1
             
+    def test_choose_cutpoints_around_d_seeded(self):
+        """Test that cutpoint selection is reproducible with a seeded generator."""
+        label_string = "VVVVNNNDDDDNNJJJJ"
+        first = [choose_cutpoints_around_d(label_string, rng=np.random.default_rng(7))
+                 for _ in range(3)]
+        second = [choose_cutpoints_around_d(label_string, rng=np.random.default_rng(7))
+                  for _ in range(3)]
+        assert first == second
+        assert choose_cutpoints_around_d("VVVVVVVV", rng=np.random.default_rng(7)) is None
+
+    def test_label_and_find_d(self):
+        """Test that the deterministic step lists every candidate cutpoint."""
+        d_index = build_d_index({"TRBD1*01": "GGGAC", "TRBD2*01": "GLAGG"})
+
+        cdr3_source, d_gene, cuts_before, cuts_after = label_and_find_d(
+            "CASSSLAGGTEAFF", "CASS", "EAFF", d_index
+        )
+        labels = label_cdr3_germline_vj_regions("CASSSLAGGTEAFF", "CASS", "EAFF")
+        assert ("CASSSLAGGTEAFF", cdr3_source, d_gene) == best_d_alignment(
+            "CASSSLAGGTEAFF", labels, None, d_index=d_index
+        )
+        assert (cdr3_source, d_gene) == ("VVVVNDDDDNJJJJ", "GLAGG")
+        assert cuts_before == (3, 4)
+        assert cuts_after == (8, 9)
+
+    def test_label_and_find_d_batch(self):
+        """Test that the batched step matches label_and_find_d row by row."""
+        d_index = build_d_index({"TRBD1*01": "GTGG.", "TRBD2*01": "GTSGG"})
+        cdr3s = ["CASSSHAGGNTEAFF", "CASSLEETQYF", "CAS"]
+        germline_vs = ["CASSI.", "CASSF.", "CASSI."]
+        germline_js = ["..NTEAFF", "..QETQYF", "..SYEQYF"]
+
+        (cdr3_sources, d_genes, before_indptr, cuts_before,
+         after_indptr, cuts_after) = label_and_find_d_batch(
+            cdr3s, germline_vs, germline_js, d_index
+        )
+        for i, row in enumerate(zip(cdr3s, germline_vs, germline_js)):
+            assert label_and_find_d(*row, d_index) == (
+                cdr3_sources[i], d_genes[i],
+                tuple(cuts_before[before_indptr[i]:before_indptr[i + 1]].tolist()),
+                tuple(cuts_after[after_indptr[i]:after_indptr[i + 1]].tolist()),
+            )
+
+    def test_sample_cutpoints(self):
+        """Test picking one candidate per row from a CSR table."""
+        indptr = np.array([0, 2, 3])
+        cuts = np.array([3, 4, 8])
+
+        picks = sample_cutpoints(indptr, cuts, np.array([0, 0, 1]), np.array([0.0, 0.99, 0.5]))
+        assert picks.tolist() == [3, 4, 8]
+
+    def test_backends_agree(self, monkeypatch):
+        """Test that the numba kernel matches the pure-Python path."""
+        if not utils._NUMBA_AVAILABLE:
+            pytest.skip("numba is not installed")
+        d_index = build_d_index({"TRBD1*01": "GTGG.", "TRBD2*01": "GTSGG"})
+        cases = [
+            ("CASSSHAGGNTEAFF", "CASSI.", "..NTEAFF"),
+            ("CASSLEETQYF", "CASSF.", "..QETQYF"),
+            ("CASSIRSSYEQYF", "CASSI.", "..SYEQYF"),
+            ("CAS", "CASSI.", "..SYEQYF"),
+        ]
+        expected = [label_and_find_d(*case, d_index) for case in cases]
+        expected_labels = [label_cdr3_germline_vj_regions(*case) for case in cases]
+        expected_d = [
+            best_d_alignment(case[0], labels, None, d_index=d_index)
+            for case, labels in zip(cases, expected_labels)
+        ]
+
+        def batch():
+            return [
+                part.tolist() if isinstance(part, np.ndarray) else part
+                for part in label_and_find_d_batch(*zip(*cases), d_index)
+            ]
+
+        def cutpoints():
+            label_strings = [row[0] for row in expected]
+            return (
+                [choose_valid_cutpoint(ls, rng=np.random.default_rng(5)) for ls in label_strings],
+                [choose_cutpoints_around_d(ls, rng=np.random.default_rng(5)) for ls in label_strings]
+            )
+
+        expected_batch = batch()
+        expected_cutpoints = cutpoints()
+        monkeypatch.setattr(utils, "_NUMBA_AVAILABLE", False)
+        assert expected == [label_and_find_d(*case, d_index) for case in cases]
+        assert expected_labels == [label_cdr3_germline_vj_regions(*case) for case in cases]
+        assert expected_d == [
+            best_d_alignment(case[0], labels, None, d_index=d_index)
+            for case, labels in zip(cases, expected_labels)
+        ]
+        assert expected_batch == batch()
+        assert expected_cutpoints == cutpoints()
+
     def test_center_pad(self):
         """Test center padding functionality."""
         germline_v = "CASS"
@@ -103,6 +223,14 @@ class TestCore:
             'jb': ['TRBJ1-1*01', 'TRBJ2-5*01', 'TRBJ2-7*01']
         })
         
+    @pytest.fixture
+    def reference(self):
+        """Beta chain reference, skipping the test if it cannot be downloaded."""
+        try:
+            return load_reference(organism="human", chain="B")
+        except OSError as e:  # includes urllib.error.URLError
+            pytest.skip(f"Could not load reference data: {e}")
+
     def test_load_reference_beta(self):
         """Test loading reference sequences for beta chain."""
         try:
@@ -125,7 +253,34 @@ class TestCore:
             assert 'A' in d['human']
         except Exception as e:
             pytest.skip(f"Could not load reference data: {e}")
-            
+
+    def test_load_reference_cached(self, reference):
+        """Test that repeated loads reuse the cached reference."""
+        second = load_reference(organism="human", chain="B")
+        assert reference[0] is second[0]
+        assert reference[1] is second[1]
+        assert load_reference(organism="human", chain="A")[0] is reference[0]
+
+    def test_load_reference_rewrites_corrupt_cache(self, tmp_path, monkeypatch):
+        """Test that an unreadable cache file is ignored and rewritten."""
+        cache_path = tmp_path / f"{core._REFERENCE_NAME}.v{core._CACHE_FORMAT}.pkl"
+        cache_path.write_bytes(b"not a pickle")
+        reference_path = tmp_path / "reference.tsv"
+        reference_path.write_text(
+            "id\torganism\tchain\tregion\tnucseq\taligned_protseq\tcdrs\n"
+            "TRBV1*01\thuman\tB\tV\tGATACT\tDTGV\tA;B;CASS\n"
+        )
+        monkeypatch.setattr(core, "_CACHE_DIR", str(tmp_path))
+        monkeypatch.setattr(core, "_REFERENCE_URL", str(reference_path))
+        core._read_reference_dict.cache_clear()
+        try:
+            d = core._read_reference_dict()
+            assert d['human']['B']['V']['TRBV1*01']['cdrs'] == 'A;B;CASS'
+            with open(cache_path, "rb") as fh:
+                assert pickle.load(fh) == d
+        finally:
+            core._read_reference_dict.cache_clear()
+
     def test_shuffle_basic(self, sample_tcr_data):
         """Test basic shuffling functionality."""
         try:
@@ -150,6 +305,22 @@ class TestCore:
         except Exception as e:
             pytest.skip(f"Could not perform shuffle test: {e}")
             
+    def test_shuffle_reproducible(self, sample_tcr_data, reference):
+        """Test that the same random seed gives the same shuffle."""
+        kwargs = dict(chain="B", v_col='vb', cdr3_col='cdr3b', j_col='jb',
+                      depth=3, random_seed=11)
+        first = shuffle(tcrs=sample_tcr_data, **kwargs)
+        second = shuffle(tcrs=sample_tcr_data, **kwargs)
+        assert first.equals(second)
+
+    def test_shuffle_logs_failure_rate(self, sample_tcr_data, reference, caplog, capsys):
+        """Test that the failure rate is logged rather than printed."""
+        with caplog.at_level("INFO", logger="tcrshuffler.core"):
+            shuffle(tcrs=sample_tcr_data, chain="B", v_col='vb',
+                    cdr3_col='cdr3b', j_col='jb', depth=1)
+        assert "failure_rate" in caplog.text
+        assert capsys.readouterr().out == ""
+
     def test_shuffle_presuffled(self, sample_tcr_data):
         """Test pre-shuffle analysis."""
         try:
@@ -175,6 +346,41 @@ class TestCore:
         except Exception as e:
             pytest.skip(f"Could not perform preshuffle test: {e}")
             
+    def test_shuffle_adds_default_allele(self, reference):
+        """Test that gene names without an allele get '*01'."""
+        data = pd.DataFrame({
+            'vb': ['TRBV19', 'TRBV12-1*01'],
+            'cdr3b': ['CASSIRSSYEQYF', 'CASSLEETQYF'],
+            'jb': ['TRBJ2-7*01', 'TRBJ2-5']
+        })
+        result = shuffle(tcrs=data, chain="B", v_col='vb', cdr3_col='cdr3b',
+                         j_col='jb', depth=1, return_presuffled=True)
+        assert set(result['v']) <= {'TRBV19*01', 'TRBV12-1*01'}
+        assert set(result['j']) <= {'TRBJ2-7*01', 'TRBJ2-5*01'}
+        assert len(result) > 0
+
+    def test_shuffle_categorical_genes(self, sample_tcr_data, reference):
+        """Test that categorical V/J columns shuffle like plain strings."""
+        categorical = sample_tcr_data.astype({'vb': 'category', 'jb': 'category'})
+        expected = shuffle(tcrs=sample_tcr_data, chain="B", depth=2, random_seed=3)
+        result = shuffle(tcrs=categorical, chain="B", depth=2, random_seed=3)
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_shuffle_backends_agree(self, sample_tcr_data, reference, monkeypatch):
+        """Test that shuffle gives the same seeded result with and without numba."""
+        if not utils._NUMBA_AVAILABLE:
+            pytest.skip("numba is not installed")
+        tcrs = pd.concat([sample_tcr_data] * 2, ignore_index=True)
+        kwargs = dict(chain="B", v_col='vb', cdr3_col='cdr3b', j_col='jb',
+                      depth=3, random_seed=17)
+        expected_presuffled = shuffle(tcrs=tcrs, return_presuffled=True, **kwargs)
+        expected = shuffle(tcrs=tcrs, **kwargs)
+        monkeypatch.setattr(utils, "_NUMBA_AVAILABLE", False)
+        pd.testing.assert_frame_equal(
+            shuffle(tcrs=tcrs, return_presuffled=True, **kwargs), expected_presuffled
+        )
+        pd.testing.assert_frame_equal(shuffle(tcrs=tcrs, **kwargs), expected)
+
     def test_shuffle_errors(self, sample_tcr_data):
         """Test error reporting."""
         try: